@@ -1,3 +1,6 @@
+import base64
+import json
+import time
 from dataclasses import dataclass
 
 
@@ -13,6 +16,24 @@ class Token:
     access_token: str
     token_type: str = "Bearer"
 
+    def is_expired(self, leeway: int = 60) -> bool:
+        """
+        Check whether the token expires within the leeway, based on its JWT "exp" claim.
+        The signature is not verified. Tokens without a readable "exp" claim count as
+        expired.
+
+        :param leeway: Seconds before expiry that count as expired already, default 60.
+        :return: True if a new token should be requested, False otherwise.
+        """
+        try:
+            payload = self.access_token.split(".")[1]
+            claims = json.loads(
+                base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4))
+            )
+            return claims["exp"] - time.time() <= leeway
+        except (IndexError, KeyError, TypeError, ValueError):
+            return True
+
 
 @dataclass
 class Credentials:
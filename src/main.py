@@ -1,11 +1,45 @@
 import asyncio
+import logging
 import os
+from logging.handlers import QueueHandler, QueueListener
+from queue import SimpleQueue
 
+import aiohttp
+import orjson
 from dotenv import load_dotenv
 
+try:
+    import uvloop
+except ImportError:  # uvloop is not available on Windows
+    uvloop = None
+
 from credentials import Credentials
 from scraper import Scraper
 
+logger = logging.getLogger(__name__)
+
+
+def _configure_logging() -> QueueListener:
+    """
+    Route all log records through a queue so writing to stderr happens on a background
+    thread instead of blocking the event loop.
+
+    :return: The started QueueListener, stop it on shutdown to flush pending records
+    """
+    queue = SimpleQueue()
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(
+        logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s")
+    )
+
+    root = logging.getLogger()
+    root.setLevel(logging.INFO)
+    root.addHandler(QueueHandler(queue))
+
+    listener = QueueListener(queue, stream_handler)
+    listener.start()
+    return listener
+
 
 async def main():
     """
@@ -21,18 +55,43 @@ async def main():
     client_id = os.getenv("CLIENT_ID")
     client_secret = os.getenv("CLIENT_SECRET")
 
-    # Create a new Scraper instance
-    credentials = Credentials(client_id, client_secret)
-    scraper = Scraper(base_api_url, credentials)
+    # Share one session and its connector across runs instead of rebuilding them.
+    # Keep-alive connections only help within a run, they expire during the hourly
+    # sleep. The DNS cache outlives it, so each run reuses the last run's lookups.
+    connector = aiohttp.TCPConnector(
+        limit=100,
+        limit_per_host=4,
+        ttl_dns_cache=3900,
+        keepalive_timeout=90,
+        enable_cleanup_closed=True,
+    )
+    timeout = aiohttp.ClientTimeout(total=15, connect=5, sock_read=10)
+    async with aiohttp.ClientSession(
+        connector=connector, timeout=timeout, json_serialize_bytes=orjson.dumps
+    ) as session:
+        # Create a new Scraper instance
+        credentials = Credentials(client_id, client_secret)
+        scraper = Scraper(base_api_url, credentials, session)
 
-    # Start the scraping loop
-    while True:
-        print("Starting scraping run")
-        await scraper.run()  # Run the scraper
-        print("Scrape finished, sleeping for 1 hour")
-        await asyncio.sleep(3600)  # Sleep for 1 hour before the next run
+        # Start the scraping loop
+        while True:
+            logger.info("Starting scraping run")
+            try:
+                await scraper.run()  # Run the scraper
+            except Exception:
+                # Keep the hourly loop alive, the next run retries against the API
+                logger.exception("Scraping run failed")
+            logger.info("Scrape finished, sleeping for 1 hour")
+            await asyncio.sleep(3600)  # Sleep for 1 hour before the next run
 
 
 # Entry point for the script
 if __name__ == "__main__":
-    asyncio.run(main())
+    listener = _configure_logging()
+    try:
+        if uvloop is not None:
+            uvloop.run(main())
+        else:
+            asyncio.run(main())
+    finally:
+        listener.stop()
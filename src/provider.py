@@ -1,4 +1,4 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, fields
 
 
 @dataclass
@@ -18,3 +18,15 @@ class Provider:
     url: str
     html_element: str
     last_accessed: str
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "Provider":
+        """
+        Build a Provider from an API response, ignoring keys it does not declare.
+
+        :param data: The provider data returned by the API.
+        :return: A Provider object with the provider data.
+        :raises TypeError: If a required field is missing from the data.
+        """
+        known = {field.name for field in fields(cls)}
+        return cls(**{key: value for key, value in data.items() if key in known})
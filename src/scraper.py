@@ -1,30 +1,182 @@
 import asyncio
+import logging
+import re
+import time
+from collections.abc import AsyncIterator
+from datetime import datetime, timezone
+from functools import lru_cache
+
 import aiohttp
-from datetime import datetime
-from bs4 import BeautifulSoup
+import orjson
+from cssselect import ExpressionError, HTMLTranslator, parse
+from cssselect.parser import CombinedSelector
+from lxml import etree
 
-from credentials import Credentials
-from credentials import Token
+from credentials import Credentials, Token
 from provider import Provider
 
+logger = logging.getLogger(__name__)
+
+# Currency symbols, thousands separators and whitespace stripped from price strings
+_PRICE_STRIP = re.compile(r"kr\.|,-|\.|\s+")
+# Danish decimal comma to decimal point
+_DECIMAL_COMMA = str.maketrans({",": "."})
+# Ask provider sites for compressed pages, aiohttp decompresses them transparently
+_SCRAPE_HEADERS = {"Accept-Encoding": "gzip, deflate, br"}
+# Keep a hung provider site from holding a semaphore slot for the whole run
+_SCRAPE_TIMEOUT = aiohttp.ClientTimeout(total=10)
+# Size of the body chunks fed to the HTML parser while a page streams in
+_SCRAPE_CHUNK_SIZE = 8192
+
+
+# CSS combinators as XPath axes from the matched element back to the element on the
+# combinator's left
+_COMBINATOR_AXES = {
+    " ": "ancestor::",
+    ">": "parent::",
+    "+": "preceding-sibling::*[1]/self::",
+    "~": "preceding-sibling::",
+}
+# Pseudo-classes that depend on content after an element's end tag, such as following
+# siblings
+_FORWARD_PSEUDO_CLASSES = re.compile(
+    r":(?:nth-last-|last-|only-|has\(|contains\()", re.IGNORECASE
+)
+
+
+def _anchored_xpath(translator: HTMLTranslator, tree, axis: str = "self::") -> str:
+    """
+    Translate a parsed CSS selector to an XPath step on the given axis. Combinators
+    become predicates on the element's ancestors and preceding siblings, so the
+    expression tests the element itself instead of selecting its descendants.
+
+    :param translator: The cssselect translator
+    :param tree: The parsed selector tree
+    :param axis: The axis the step is evaluated on, default is the element itself
+    :return: The XPath step
+    """
+    if isinstance(tree, CombinedSelector):
+        anchor = _anchored_xpath(
+            translator, tree.selector, _COMBINATOR_AXES[tree.combinator]
+        )
+        return f"{_anchored_xpath(translator, tree.subselector, axis)}[{anchor}]"
+    return f"{axis}{translator.xpath(tree)}"
+
+
+@lru_cache(maxsize=512)
+def _compile_selector(selector: str) -> etree.XPath:
+    """
+    Compile a CSS selector to an XPath expression that matches the element it is
+    evaluated on. Providers are scraped with the same selectors every run, so compiled
+    selectors are cached.
+
+    :param selector: The CSS selector for the price element
+    :return: The compiled XPath expression
+    """
+    translator = HTMLTranslator()
+    steps = []
+    for parsed in parse(selector):
+        if parsed.pseudo_element:
+            raise ExpressionError(f"Pseudo-elements are not supported: {selector}")
+        steps.append(_anchored_xpath(translator, parsed.parsed_tree))
+    return etree.XPath(" | ".join(steps))
+
+
+def _first_match_text(
+    parser: etree.HTMLPullParser, selector: etree.XPath
+) -> str | None:
+    """
+    Consume the parser's pending end events and return the text of the first matching
+    element. A matching element nested in another match is skipped, the outer one comes
+    first in document order and is returned at its own end event.
+
+    :param parser: The pull parser fed with the page so far
+    :param selector: The compiled selector for the price element
+    :return: The text of the matched element, or None if no element matched yet
+    """
+    for _, element in parser.read_events():
+        if selector(element) and not any(
+            selector(ancestor) for ancestor in element.iterancestors()
+        ):
+            return element.xpath("string()")
+    return None
+
 
 class Scraper:
     """
     A class to represent a web scraper.
     """
 
-    def __init__(self, base_url, credentials: Credentials):
+    def __init__(
+        self,
+        base_url,
+        credentials: Credentials,
+        session: aiohttp.ClientSession,
+        max_concurrent_scrapes: int = 20,
+        providers_ttl: float = 6 * 3600,
+    ):
         """
-        Initialize the Scraper with a base URL and credentials.
+        Initialize the Scraper with a base URL, credentials and a shared session.
 
         :param base_url: The base URL for the API.
         :param credentials: The credentials for authentication.
+        :param session: The aiohttp session reused across all runs.
+        :param max_concurrent_scrapes: Most pages fetched at once, default is 20.
+        :param providers_ttl: Seconds the provider list is reused, default is 6 hours.
         """
         self.base_url = base_url
         self.credentials = credentials
-        self.providers = []
-        self.run_start = datetime.now()
-        self.run_end = None
+        self.session = session
+        self.scrape_semaphore = asyncio.Semaphore(max_concurrent_scrapes)
+        self.providers: list[Provider] = []
+        self.providers_ttl = providers_ttl
+        self.providers_fetched_at: float | None = None
+        self.providers_etag: str | None = None
+        self.bulk_prices_supported = True
+        self.run_start: datetime | None = None
+        self.run_end: datetime | None = None
+        self._auth_headers: dict[str, str] = {}
+        self._token_lock = asyncio.Lock()
+
+    async def _api_request(
+        self,
+        session: aiohttp.ClientSession,
+        method: str,
+        path: str,
+        headers: dict[str, str] | None = None,
+        **kwargs,
+    ) -> aiohttp.ClientResponse:
+        """
+        Send an authenticated request to the API. The token is only attached here, so it
+        is never sent to the provider websites sharing the session. If the API rejects
+        the token, a new one is requested and the request is retried once.
+
+        :param session: The aiohttp session
+        :param method: The HTTP method
+        :param path: The API path, relative to the base URL
+        :param headers: Extra headers for the request
+        :param kwargs: Further arguments for aiohttp.ClientSession.request
+        :return: The aiohttp response
+        """
+        url = f"{self.base_url}{path}"
+        sent_auth_headers = self._auth_headers
+        response = await session.request(
+            method, url, headers={**sent_auth_headers, **(headers or {})}, **kwargs
+        )
+        if response.status != 401:
+            return response
+
+        # The token was revoked or the keys rotated before it expired
+        response.release()
+        async with self._token_lock:
+            # Concurrent requests rejected with the same token share a single login
+            if self._auth_headers is sent_auth_headers:
+                logger.info("Token rejected by the API, requesting a new one")
+                self.credentials.token = None
+                await self._get_token(session)
+        return await session.request(
+            method, url, headers={**self._auth_headers, **(headers or {})}, **kwargs
+        )
 
     async def _post_run(self, session: aiohttp.ClientSession) -> None:
         """
@@ -33,29 +185,81 @@ class Scraper:
         :param session: The aiohttp session
         :return: None
         """
-        self.run_end = datetime.now()
+        self.run_end = datetime.now(timezone.utc)
         json_body = {
             "start_time": self.run_start.isoformat(),
             "end_time": self.run_end.isoformat(),
         }
-        async with session.post(
-            f"{self.base_url}/scraping_runs", json=json_body
+        async with await self._api_request(
+            session, "POST", "/scraping_runs", json=json_body
         ) as response:
             await response.text()
 
     async def _fetch_providers(self, session: aiohttp.ClientSession) -> None:
         """
-        Fetch all providers from the API.
+        Fetch all providers from the API. Provider metadata rarely changes, so the list
+        is reused until it is older than the providers TTL, and then revalidated with
+        its ETag.
 
         :param session: The aiohttp session
         :return: None
         """
-        async with session.get(f"{self.base_url}/scraping_runs/providers") as response:
-            if response.status == 200:
-                self.providers = await response.json()
-            else:
+        if (
+            self.providers_fetched_at is not None
+            and time.monotonic() - self.providers_fetched_at < self.providers_ttl
+        ):
+            return
+
+        headers = (
+            {"If-None-Match": self.providers_etag} if self.providers_etag else None
+        )
+        async with await self._api_request(
+            session, "GET", "/scraping_runs/providers", headers=headers
+        ) as response:
+            if response.status == 304:
+                self.providers_fetched_at = time.monotonic()
+                return
+            if response.status != 200:
                 raise Exception(f"Failed to fetch providers: {response.status}")
 
+            rows = orjson.loads(await response.read())
+            etag = response.headers.get("ETag")
+
+        # A provider that cannot be resolved must not abort the run
+        results = await asyncio.gather(
+            *[self._to_provider(session, row) for row in rows], return_exceptions=True
+        )
+
+        self.providers = []
+        for row, result in zip(rows, results):
+            if isinstance(result, BaseException):
+                logger.warning(
+                    "Failed to resolve provider %s: %r", row.get("id"), result
+                )
+            else:
+                self.providers.append(result)
+
+        # Only cache a complete list, so failed providers are retried on the next run
+        if len(self.providers) == len(rows):
+            self.providers_etag = etag
+            self.providers_fetched_at = time.monotonic()
+        else:
+            self.providers_etag = None
+
+    async def _to_provider(self, session: aiohttp.ClientSession, row: dict) -> Provider:
+        """
+        Build a Provider from a provider list entry. Older APIs only return the id in
+        the list, so an entry missing any provider field is fetched separately.
+
+        :param session: The aiohttp session
+        :param row: The provider entry from the provider list
+        :return: A Provider object with the provider data
+        """
+        try:
+            return Provider.from_dict(row)
+        except TypeError:
+            return await self._get_provider(session, row["id"])
+
     async def _get_provider(self, session: aiohttp.ClientSession, id: int) -> Provider:
         """
         Fetch a provider by id.
@@ -64,9 +268,11 @@ class Scraper:
         :param id: The provider id to fetch
         :return: A Provider object with the provider data
         """
-        async with session.get(f"{self.base_url}/providers/{id}") as response:
+        async with await self._api_request(
+            session, "GET", f"/providers/{id}"
+        ) as response:
             if response.status == 200:
-                return Provider(**await response.json())
+                return Provider.from_dict(orjson.loads(await response.read()))
             else:
                 raise Exception(f"Failed to fetch provider {id}: {response.status}")
 
@@ -81,11 +287,50 @@ class Scraper:
         :param price: The price to add for the provider
         :return: True if the price was added successfully, False otherwise
         """
-        url = f"{self.base_url}/providers/{provider_id}/prices"
         json_price = {"price": price}
-        async with session.post(url, json=json_price) as response:
+        async with await self._api_request(
+            session, "POST", f"/providers/{provider_id}/prices", json=json_price
+        ) as response:
             return response.status in {200, 201}
 
+    async def _add_prices(
+        self, session: aiohttp.ClientSession, prices: list[tuple[int, float]]
+    ) -> None:
+        """
+        Add prices for several providers in a single request. Falls back to one request
+        per provider if the API does not support bulk submissions, and remembers that
+        for later runs. Other failures are logged.
+
+        :param session: The aiohttp session
+        :param prices: The (provider id, price) pairs to add
+        :return: None
+        """
+        if self.bulk_prices_supported:
+            json_prices = [
+                {"provider_id": provider_id, "price": price}
+                for provider_id, price in prices
+            ]
+            async with await self._api_request(
+                session, "POST", "/prices/bulk", json=json_prices
+            ) as response:
+                if response.status in {200, 201}:
+                    logger.info("Prices added for %d providers", len(prices))
+                    return
+                if response.status not in {404, 405}:
+                    # Keep the daemon running, the prices are scraped again next run
+                    logger.warning("Failed to add prices: %s", response.status)
+                    return
+
+            logger.info("Bulk price endpoint not available, adding prices one by one")
+            self.bulk_prices_supported = False
+
+        # Legacy API without the bulk endpoint
+        for provider_id, price in prices:
+            if await self._add_price_for_provider(session, provider_id, price):
+                logger.info("Price added for provider: %s", provider_id)
+            else:
+                logger.warning("Failed to add price for provider: %s", provider_id)
+
     @staticmethod
     def _sanitize_price_string(price_string: str) -> float:
         """
@@ -94,18 +339,53 @@ class Scraper:
         :param price_string: String representation of the price.
         :return: The price as a float without any non-numeric characters and currency symbols
         """
-        sanitized = (
-            price_string.replace("kr.", "")
-            .replace(",-", "")
-            .replace(".", "")
-            .replace(",", ".")
-            .replace(" ", "")
-        )
+        sanitized = _PRICE_STRIP.sub("", price_string).translate(_DECIMAL_COMMA)
         try:
             return float(sanitized)
         except ValueError as e:
             raise ValueError(f"Failed to parse price: {e}")
 
+    @staticmethod
+    async def _stream_price_string(
+        chunks: AsyncIterator[bytes], selector: str, encoding: str | None = None
+    ) -> str | None:
+        """
+        Parse the page chunk by chunk and stop reading at the first element matching the
+        selector. Network and parsing overlap, but the tree parsed so far is kept in
+        memory, and stopping early means aiohttp closes the connection instead of
+        returning it to the pool. Selectors with pseudo-classes that look past an
+        element's end tag, such as :last-child, are only matched once the whole page has
+        been parsed.
+
+        :param chunks: The body chunks of the provider's website
+        :param selector: The CSS selector for the price element
+        :param encoding: The charset of the response, detected from the page if None
+        :return: The text of the matched element, or None if no element matched
+        """
+        compiled = _compile_selector(selector)
+        streaming = _FORWARD_PSEUDO_CLASSES.search(selector) is None
+        parser = etree.HTMLPullParser(
+            events=("end",) if streaming else (), encoding=encoding
+        )
+        async for chunk in chunks:
+            parser.feed(chunk)
+            if streaming:
+                price_string = _first_match_text(parser, compiled)
+                if price_string is not None:
+                    return price_string
+
+        try:
+            root = parser.close()
+        except etree.XMLSyntaxError:
+            # Empty page
+            return None
+        if streaming:
+            return _first_match_text(parser, compiled)
+        for element in root.iter():
+            if compiled(element):
+                return element.xpath("string()")
+        return None
+
     async def _handle_scraping(self, session: aiohttp.ClientSession) -> None:
         """
         Scrape all providers. This is the main scraping loop.
@@ -117,67 +397,88 @@ class Scraper:
         tasks = [
             self._scrape_provider(session, provider) for provider in self.providers
         ]
-        await asyncio.gather(*tasks)
+        # A failing provider must not cancel the others
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+
+        prices = []
+        for provider, result in zip(self.providers, results):
+            if isinstance(result, BaseException):
+                logger.warning(
+                    "Failed to scrape provider %s: %r", provider.name, result
+                )
+            elif result is not None:
+                prices.append(result)
+        if prices:
+            await self._add_prices(session, prices)
 
     async def _scrape_provider(
-        self, session: aiohttp.ClientSession, provider: dict
-    ) -> None:
+        self, session: aiohttp.ClientSession, provider_obj: Provider
+    ) -> tuple[int, float] | None:
         """
         Scrape a single provider.
 
         :param session: The aiohttp session
-        :param provider: The provider to scrape
-        :return: None
+        :param provider_obj: The provider to scrape
+        :return: The provider id and scraped price, or None if no valid price was found
         """
 
-        provider_obj = await self._get_provider(session, provider["id"])
-
-        # Scrape the provider's website
-        async with session.get(provider_obj.url) as response:
+        # Scrape the provider's website, limiting how many pages are fetched at once
+        async with (
+            self.scrape_semaphore,
+            session.get(
+                provider_obj.url, headers=_SCRAPE_HEADERS, timeout=_SCRAPE_TIMEOUT
+            ) as response,
+        ):
             if response.status != 200:
-                print(
-                    f"Failed to scrape provider {provider_obj.name}, status: {response.status}"
+                logger.warning(
+                    "Failed to scrape provider %s, status: %s",
+                    provider_obj.name,
+                    response.status,
                 )
-                return
+                return None
 
-            # Parse the HTML response
-            body = await response.text()
-            document = BeautifulSoup(body, "html.parser")
-            element = document.select_one(provider_obj.html_element)
-
-            # Extract the price from the HTML element and add it to the API
-            if element:
-                price_string = element.get_text()
-                try:
-                    price = self._sanitize_price_string(price_string)
-                    if price > 0 and await self._add_price_for_provider(
-                        session, provider_obj.id, price
-                    ):
-                        # Update the last accessed time for the provider
-                        await session.put(
-                            f"{self.base_url}/providers/{provider_obj.id}/last_accessed"
-                        )
-                        print(f"Price added for provider: {provider_obj.name}")
-                    else:
-                        print(f"Failed to add price for provider: {provider_obj.name}")
-                except Exception as e:
-                    print(
-                        f"Error processing price for provider {provider_obj.name}: {e}"
-                    )
-            else:
-                print(f"No price found for provider {provider_obj.name}")
+            # Parse the HTML response while it streams in
+            price_string = await self._stream_price_string(
+                response.content.iter_chunked(_SCRAPE_CHUNK_SIZE),
+                provider_obj.html_element,
+                response.charset,
+            )
+
+        # Extract the price from the HTML element
+        if price_string is None:
+            logger.warning("No price found for provider %s", provider_obj.name)
+            return None
+
+        try:
+            price = self._sanitize_price_string(price_string)
+        except Exception as e:
+            logger.warning(
+                "Error processing price for provider %s: %s", provider_obj.name, e
+            )
+            return None
+
+        if price <= 0:
+            logger.warning("Invalid price for provider: %s", provider_obj.name)
+            return None
+
+        return provider_obj.id, price
 
-    async def _set_token(self, json: dict[str, str]) -> None:
+    def _set_token(self, json: dict[str, str]) -> None:
         """
-        Set the token from the JSON response.
+        Set the token from the JSON response and build the Authorization header for API
+        requests.
 
         :param json: The JSON response from the API
         :return: None
         """
         # Set the token from the JSON response
-        self.credentials.token = Token(
-            access_token=json["access_token"], token_type=json["token_type"]
-        )
+        token = Token(access_token=json["access_token"], token_type=json["token_type"])
+        self.credentials.token = token
+
+        # Build the Authorization header once, every API request reuses it
+        self._auth_headers = {
+            "Authorization": f"{token.token_type} {token.access_token}"
+        }
 
     async def _get_token(self, session: aiohttp.ClientSession) -> None:
         """
@@ -195,24 +496,12 @@ class Scraper:
         # Make a POST request to the API to get the token
         async with session.post(url, json=json_data) as response:
             if response.status == 200:
-                await self._set_token(await response.json())
+                self._set_token(orjson.loads(await response.read()))
             else:
                 raise Exception(
-                    f"Failed to get token: {response.status}, {await response.json()}"
+                    f"Failed to get token: {response.status}, {await response.text()}"
                 )
 
-    async def _configure_client(self):
-        """
-        Configure the aiohttp client with the token.
-
-        :return: aiohttp.ClientSession
-        """
-        return aiohttp.ClientSession(
-            headers={
-                "Authorization": f"{self.credentials.token.token_type} {self.credentials.token.access_token}"
-            }
-        )
-
     async def run(self):
         """
         Run the scraper.
@@ -220,16 +509,12 @@ class Scraper:
         :return: None
         """
         # Set the start time of the run
-        self.run_start = datetime.now()
-
-        # Create a new aiohttp session
-        async with aiohttp.ClientSession() as session:
-            # Get the token
-            await self._get_token(session)
-
-            # Create a new session with the token
-            auth_session = await self._configure_client()
-            async with auth_session:
-                await self._fetch_providers(auth_session)
-                await self._handle_scraping(auth_session)
-                await self._post_run(auth_session)
+        self.run_start = datetime.now(timezone.utc)
+
+        # Get a new token unless the one from a previous run is still valid
+        if self.credentials.token is None or self.credentials.token.is_expired():
+            await self._get_token(self.session)
+
+        await self._fetch_providers(self.session)
+        await self._handle_scraping(self.session)
+        await self._post_run(self.session)
@@ -0,0 +1,35 @@
+import base64
+import json
+import time
+
+from credentials import Token
+
+
+def _jwt(claims: dict) -> str:
+    payload = base64.urlsafe_b64encode(json.dumps(claims).encode()).decode().rstrip("=")
+    return f"header.{payload}.signature"
+
+
+def test_token_is_not_expired_before_exp():
+    token = Token(_jwt({"exp": time.time() + 3600}))
+    assert not token.is_expired()
+
+
+def test_token_is_expired_within_leeway():
+    token = Token(_jwt({"exp": time.time() + 30}))
+    assert token.is_expired()
+    assert not token.is_expired(leeway=0)
+
+
+def test_token_is_expired_after_exp():
+    token = Token(_jwt({"exp": time.time() - 10}))
+    assert token.is_expired()
+
+
+def test_token_without_exp_claim_is_expired():
+    assert Token(_jwt({"sub": "scraper"})).is_expired()
+
+
+def test_opaque_token_is_expired():
+    assert Token("not-a-jwt").is_expired()
+    assert Token("header.!!!.signature").is_expired()
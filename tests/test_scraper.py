@@ -0,0 +1,298 @@
+import asyncio
+
+import aiohttp
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from credentials import Credentials, Token
+from scraper import Scraper, _compile_selector
+
+
+@pytest.mark.asyncio
+async def test_api_request_renews_rejected_token():
+    async def login(request):
+        return web.json_response({"access_token": "fresh", "token_type": "Bearer"})
+
+    async def providers(request):
+        if request.headers.get("Authorization") != "Bearer fresh":
+            return web.Response(status=401)
+        return web.json_response([])
+
+    app = web.Application()
+    app.router.add_post("/auth/login", login)
+    app.router.add_get("/scraping_runs/providers", providers)
+
+    async with TestServer(app) as server, aiohttp.ClientSession() as session:
+        credentials = Credentials("id", "secret", Token("revoked"))
+        scraper = Scraper(str(server.make_url("")).rstrip("/"), credentials, session)
+        scraper._auth_headers = {"Authorization": "Bearer revoked"}
+
+        async with await scraper._api_request(
+            session, "GET", "/scraping_runs/providers"
+        ) as response:
+            assert response.status == 200
+
+        assert credentials.token.access_token == "fresh"
+
+
+@pytest.mark.asyncio
+async def test_api_request_renews_token_once_for_concurrent_rejections():
+    logins = []
+
+    async def login(request):
+        logins.append(request)
+        return web.json_response({"access_token": "fresh", "token_type": "Bearer"})
+
+    async def get_provider(request):
+        if request.headers.get("Authorization") != "Bearer fresh":
+            return web.Response(status=401)
+        return web.json_response({})
+
+    app = web.Application()
+    app.router.add_post("/auth/login", login)
+    app.router.add_get("/providers/{id}", get_provider)
+
+    async with TestServer(app) as server, aiohttp.ClientSession() as session:
+        credentials = Credentials("id", "secret", Token("revoked"))
+        scraper = Scraper(str(server.make_url("")).rstrip("/"), credentials, session)
+        scraper._auth_headers = {"Authorization": "Bearer revoked"}
+
+        responses = await asyncio.gather(
+            *[scraper._api_request(session, "GET", f"/providers/{i}") for i in range(5)]
+        )
+        for response in responses:
+            assert response.status == 200
+            response.release()
+
+    assert len(logins) == 1
+
+
+@pytest.mark.asyncio
+async def test_fetch_providers_drops_providers_that_fail_to_resolve():
+    provider = {
+        "id": 1,
+        "name": "Olie",
+        "url": "https://example.com",
+        "html_element": ".p",
+        "last_accessed": "",
+    }
+
+    async def providers(request):
+        return web.json_response([{"id": 1}, {"id": 2}], headers={"ETag": '"v1"'})
+
+    async def get_provider(request):
+        if request.match_info["id"] == "1":
+            return web.json_response(provider)
+        return web.Response(status=404)
+
+    app = web.Application()
+    app.router.add_get("/scraping_runs/providers", providers)
+    app.router.add_get("/providers/{id}", get_provider)
+
+    async with TestServer(app) as server, aiohttp.ClientSession() as session:
+        scraper = Scraper(
+            str(server.make_url("")).rstrip("/"), Credentials("id", "secret"), session
+        )
+        await scraper._fetch_providers(session)
+
+        assert [p.id for p in scraper.providers] == [1]
+        assert scraper.providers_fetched_at is None
+        assert scraper.providers_etag is None
+
+
+@pytest.mark.asyncio
+async def test_fetch_providers_reuses_list_within_ttl_and_revalidates_with_etag():
+    provider = {
+        "id": 1,
+        "name": "Olie",
+        "url": "https://example.com",
+        "html_element": ".p",
+        "last_accessed": "",
+    }
+    requests = []
+
+    async def providers(request):
+        requests.append(request.headers.get("If-None-Match"))
+        if request.headers.get("If-None-Match") == '"v1"':
+            return web.Response(status=304)
+        return web.json_response([provider], headers={"ETag": '"v1"'})
+
+    app = web.Application()
+    app.router.add_get("/scraping_runs/providers", providers)
+
+    async with TestServer(app) as server, aiohttp.ClientSession() as session:
+        base_url = str(server.make_url("")).rstrip("/")
+        scraper = Scraper(base_url, Credentials("id", "secret"), session)
+
+        # A second fetch within the TTL is served from the cached list
+        await scraper._fetch_providers(session)
+        await scraper._fetch_providers(session)
+        assert requests == [None]
+
+        # After the TTL the list is revalidated and a 304 keeps it
+        scraper.providers_fetched_at -= scraper.providers_ttl
+        expired_at = scraper.providers_fetched_at
+        await scraper._fetch_providers(session)
+
+        assert requests == [None, '"v1"']
+        assert [p.id for p in scraper.providers] == [1]
+        assert scraper.providers_fetched_at > expired_at
+
+
+@pytest.mark.asyncio
+async def test_fetch_providers_ignores_unknown_keys_and_fetches_incomplete_entries():
+    provider = {
+        "id": 1,
+        "name": "Olie",
+        "url": "https://example.com",
+        "html_element": ".p",
+        "last_accessed": "",
+    }
+    fetched = []
+
+    async def providers(request):
+        return web.json_response(
+            [{**provider, "active": True}, {"id": 2, "name": "Diesel", "url": "x"}]
+        )
+
+    async def get_provider(request):
+        fetched.append(request.match_info["id"])
+        return web.json_response({**provider, "id": 2, "created_at": "2024-01-01"})
+
+    app = web.Application()
+    app.router.add_get("/scraping_runs/providers", providers)
+    app.router.add_get("/providers/{id}", get_provider)
+
+    async with TestServer(app) as server, aiohttp.ClientSession() as session:
+        base_url = str(server.make_url("")).rstrip("/")
+        scraper = Scraper(base_url, Credentials("id", "secret"), session)
+        await scraper._fetch_providers(session)
+
+        assert fetched == ["2"]
+        assert [p.id for p in scraper.providers] == [1, 2]
+
+
+def _prices_app(bulk_status: int, requests: list[str]) -> web.Application:
+    async def bulk(request):
+        requests.append("bulk")
+        return web.Response(status=bulk_status)
+
+    async def price(request):
+        requests.append(request.match_info["id"])
+        return web.Response(status=201)
+
+    app = web.Application()
+    app.router.add_post("/prices/bulk", bulk)
+    app.router.add_post("/providers/{id}/prices", price)
+    return app
+
+
+@pytest.mark.asyncio
+async def test_add_prices_falls_back_to_per_provider_posts_on_legacy_api():
+    requests = []
+    app = _prices_app(404, requests)
+
+    async with TestServer(app) as server, aiohttp.ClientSession() as session:
+        base_url = str(server.make_url("")).rstrip("/")
+        scraper = Scraper(base_url, Credentials("id", "secret"), session)
+        await scraper._add_prices(session, [(1, 10.5), (2, 11.0)])
+        await scraper._add_prices(session, [(3, 12.0)])
+
+    # The bulk endpoint is only tried once, later runs go straight to the fallback
+    assert requests == ["bulk", "1", "2", "3"]
+    assert not scraper.bulk_prices_supported
+
+
+@pytest.mark.asyncio
+async def test_add_prices_logs_bulk_failure_without_raising():
+    requests = []
+    app = _prices_app(500, requests)
+
+    async with TestServer(app) as server, aiohttp.ClientSession() as session:
+        base_url = str(server.make_url("")).rstrip("/")
+        scraper = Scraper(base_url, Credentials("id", "secret"), session)
+        await scraper._add_prices(session, [(1, 10.5)])
+
+    assert requests == ["bulk"]
+    assert scraper.bulk_prices_supported
+
+
+PAGE = (
+    b"<html><body>"
+    b'<div class="box"><h2>Pris</h2><span class="p">12,50 kr.</span><em>more</em></div>'
+    b'<p class="other"><span class="p">99</span></p>'
+    b'<ul><li class="price">1,00</li><li class="price">2,00</li></ul>'
+    b"</body></html>"
+)
+
+
+async def _chunks(body: bytes, size: int = 16):
+    for i in range(0, len(body), size):
+        yield body[i : i + size]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "selector, expected",
+    [
+        ("span.p", "12,50 kr."),
+        ("div.box span.p", "12,50 kr."),
+        (".box > .p", "12,50 kr."),
+        ("div.box span", "12,50 kr."),
+        ("p.other span", "99"),
+        ("h2 + span", "12,50 kr."),
+        ("h2 ~ em", "more"),
+        ("li.price:nth-child(2)", "2,00"),
+        ("li:last-child", "2,00"),
+        ("div, span", "Pris12,50 kr.more"),
+        (".missing", None),
+    ],
+)
+async def test_stream_price_string_matches_selector(selector, expected):
+    assert await Scraper._stream_price_string(_chunks(PAGE), selector) == expected
+
+
+@pytest.mark.asyncio
+async def test_stream_price_string_empty_page():
+    assert await Scraper._stream_price_string(_chunks(b""), "span.p") is None
+
+
+@pytest.mark.asyncio
+async def test_stream_price_string_stops_reading_after_match():
+    read = []
+
+    async def chunks():
+        for chunk in [
+            b'<html><body><span class="p">12,50</span>',
+            b"<p>rest</p>",
+            b"</body></html>",
+        ]:
+            read.append(chunk)
+            yield chunk
+
+    assert await Scraper._stream_price_string(chunks(), "span.p") == "12,50"
+    assert len(read) == 1
+
+
+def test_compile_selector_is_cached():
+    assert _compile_selector("div.box span.p") is _compile_selector("div.box span.p")
+
+
+@pytest.mark.parametrize(
+    "price_string, expected",
+    [
+        ("12.345,67 kr.", 12345.67),
+        ("kr. 9.999,-", 9999.0),
+        ("1 234,5", 1234.5),
+        ("1\xa0234,50 kr.", 1234.5),
+        ("10,95", 10.95),
+    ],
+)
+def test_sanitize_price_string(price_string, expected):
+    assert Scraper._sanitize_price_string(price_string) == expected
+
+
+def test_sanitize_price_string_rejects_text():
+    with pytest.raises(ValueError):
+        Scraper._sanitize_price_string("Ring for pris")